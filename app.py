@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 import os
+import atexit
+import sys
+import re
+import html
+import json
+import math
 import threading
 import time
-import json
-import queue
 import signal
-from datetime import datetime, timezone, timedelta
+import socket
+import stat
+from collections import deque
+from hashlib import blake2b
+from importlib.util import find_spec
+from datetime import datetime, timezone
 from pathlib import Path
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 from flask import Flask, Response, render_template, jsonify, request
 
@@ -56,38 +68,179 @@ def load_config():
 
 CFG = load_config()
 
-def get_by_path(obj, dotted):
-    if not dotted:
+def _encode_cfg_view(cfg):
+    return orjson.dumps(cfg, option=orjson.OPT_NON_STR_KEYS)
+
+def _rebuild_public_cfg_view(view=None):
+    global _public_cfg_json
+    if view is None:
+        try:
+            view = _encode_cfg_view(CFG)
+        except TypeError as e:
+            # e.g. an integer beyond 64 bits in config.yaml; don't refuse to start over it
+            print(f"[WARN] config not JSON-encodable by orjson ({e}); using stdlib json")
+            view = json.dumps(CFG, default=str).encode("utf-8")
+    _public_cfg_json = view
+
+_rebuild_public_cfg_view()
+
+KEY_FIELDS = ("latitude", "longitude", "altitude", "gps_time")
+
+def build_key_paths(cfg):
+    paths = {}
+    for f in KEY_FIELDS:
+        dotted = cfg.get(f"{f}_key")
+        if dotted is not None and not isinstance(dotted, str):
+            print(f"[WARN] {f}_key must be a string, ignoring {dotted!r}")
+            dotted = None
+        paths[f] = tuple(dotted.split(".")) if dotted else ()
+    return paths
+
+_key_paths = build_key_paths(CFG)
+
+def get_by_path(obj, parts):
+    if not parts:
         return None
-    cur = obj
-    for p in dotted.split("."):
-        if isinstance(cur, dict) and p in cur:
+    try:
+        cur = obj
+        for p in parts:
             cur = cur[p]
-        else:
-            return None
-    return cur
+        return cur
+    except (KeyError, TypeError, IndexError):
+        return None
 
 def coerce_float(v):
     try: return float(v)
     except Exception: return None
 
-GPS_EPOCH = datetime(1980, 1, 6, tzinfo=timezone.utc)
+_SIMPLE_SEL_RE = re.compile(r"^([A-Za-z][A-Za-z0-9]*)\.([A-Za-z_-][A-Za-z0-9_-]*)$")
 
-def gps_seconds_to_utc(gps_seconds, leap_seconds):
+def compile_selector(sel):
+    # Fast path for the common "tag.class" selector; anything else goes through bs4.
+    m = _SIMPLE_SEL_RE.match(sel.strip()) if isinstance(sel, str) else None
+    if m is None:
+        return None
+    tag, cls = m.groups()
+    return tag.lower(), cls
+
+_fast_sel = compile_selector(CFG["css_selector"])
+
+# A strict subset of what html.parser accepts as start/end tags; anything the
+# scanner can't tokenize is left to bs4.
+_TAG_TOKEN_RE = re.compile(
+    r'<(/?)([A-Za-z][^\s/>]*)'
+    r'((?:\s+[^\s"\'>/=]+(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'>]+))?)*)\s*(/?)>'
+)
+_ATTR_RE = re.compile(r'\s+([^\s"\'>/=]+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s"\'>]+))?')
+_DOCTYPE_RE = re.compile(r"<!(?i:doctype)[^>]*>")
+# Elements whose content html.parser doesn't tokenize as ordinary markup.
+_OPAQUE_TAGS = frozenset((
+    "script", "style", "textarea", "title", "template", "noscript",
+    "xmp", "iframe", "noembed", "noframes", "plaintext",
+))
+
+def extract_selector_fast(page):
+    """Return the text of the first tag.class match, or None if unsure.
+
+    Walks the start tags in document order, as select_one does, and gives up
+    on comments, opaque elements, duplicate class attributes, nested markup
+    or anything else it can't tokenize, so it never disagrees with bs4.
+    """
+    if _fast_sel is None:
+        return None
+    tag, cls = _fast_sel
+    pos = 0
+    while True:
+        pos = page.find("<", pos)
+        if pos == -1:
+            return None
+        m = _TAG_TOKEN_RE.match(page, pos)
+        if m is None:
+            m = _DOCTYPE_RE.match(page, pos)
+            if m is None:
+                return None
+            pos = m.end()
+            continue
+        pos = m.end()
+        closing, name, attrs, self_closing = m.groups()
+        if closing:
+            continue
+        name = name.lower()
+        if name in _OPAQUE_TAGS:
+            return None
+        if name != tag:
+            continue
+        classes = [v for k, v in _ATTR_RE.findall(attrs) if k.lower() == "class"]
+        if not classes:
+            continue
+        if len(classes) > 1:
+            return None
+        value = classes[0]
+        if value[:1] in ("\"", "'"):
+            value = value[1:-1]
+        if cls not in html.unescape(value).split():
+            continue
+        if self_closing:
+            return None
+        end = page.find("<", pos)
+        close = _TAG_TOKEN_RE.match(page, end) if end != -1 else None
+        if close is None or not close.group(1) or close.group(2).lower() != tag:
+            return None
+        return html.unescape(page[pos:end]).strip()
+
+def extract_selector_text(page, sel):
+    node = BeautifulSoup(page, "html.parser").select_one(sel)
+    if node is None:
+        return None
+    return node.get_text(strip=True)
+
+GPS_EPOCH_POSIX = 315964800.0  # 1980-01-06T00:00:00Z
+
+def gps_seconds_to_ts(gps_seconds, leap_seconds):
     try:
-        dt_gps = GPS_EPOCH + timedelta(seconds=float(gps_seconds))
-        return dt_gps - timedelta(seconds=int(leap_seconds))
+        return GPS_EPOCH_POSIX + float(gps_seconds) - int(leap_seconds)
     except Exception:
         return None
 
+def ts_to_utc(ts):
+    try:
+        return datetime.fromtimestamp(ts, tz=timezone.utc)
+    except Exception:
+        return None
+
+class _PollingAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets disable Nagle and use keepalive."""
+    SOCKET_OPTIONS = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        (socket.SOL_SOCKET, socket.SO_RCVBUF, 65536),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+def _make_session():
+    s = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    adapter = _PollingAdapter(pool_connections=2, pool_maxsize=4, max_retries=retry)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    s.headers["Connection"] = "keep-alive"
+    return s
+
+_session = _make_session()
+
 app = Flask(__name__)
-_updates = queue.Queue()
+_subs_lock = threading.Lock()
+_subscribers = []  # (threading.Condition, deque) per /stream client
+# _state is an immutable snapshot: readers grab the reference without locking,
+# writers build a new dict and rebind it under _lock.
 _lock = threading.Lock()
 _state = {
     "latitude": None,
     "longitude": None,
     "altitude": None,
-    "last_raw": None,
     "last_update_iso": None,
     "note": "Waiting for first update...",
     "runtime_file_path": CFG["runtime_file_path"],
@@ -100,8 +253,72 @@ _state = {
     "delta_ntp_vs_gps_ms": None,
 }
 
+# Source JSON text of the latest update, kept out of _state and only
+# served by /api/state?include_raw=1.
+_last_raw_json = None
+
+def _set_state(fields):
+    global _state
+    with _lock:
+        new_state = dict(_state)
+        new_state.update(fields)
+        _state = new_state
+
+def _publish(item):
+    with _subs_lock:
+        subs = list(_subscribers)
+    for cond, dq in subs:
+        with cond:
+            dq.append(item)
+            cond.notify()
+
 _ntp_lock = threading.Lock()
-_last_ntp_utc = None
+_last_ntp_offset = None  # seconds to add to the PC clock to get NTP time
+
+def _offload(fn, *args, **kwargs):
+    # Under gunicorn's gevent worker our "threads" are greenlets, so blocking
+    # syscalls (fsync) or long CPU work (bs4) would stall every /stream client.
+    # Hand them to gevent's native threadpool instead.
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is not None and monkey.is_module_patched("threading"):
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
+
+def _atomic_write_bytes(path, data, mode=0o644, owner=None):
+    _offload(_atomic_write_bytes_sync, path, data, mode=mode, owner=owner)
+
+def _atomic_write_bytes_sync(path, data, mode=0o644, owner=None):
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        try:
+            os.fchmod(fd, mode)  # explicit, so the umask doesn't apply
+            if owner is not None:
+                try:
+                    os.fchown(fd, *owner)
+                except PermissionError:
+                    pass  # only root can give the file away; keep ours
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    # fsync the directory so the rename itself survives a crash.
+    dfd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dfd)
+    finally:
+        os.close(dfd)
 
 def _write_runtime_file(lat, lon, alt):
     if not CFG.get("write_latest_to_runtime_file", True):
@@ -113,20 +330,89 @@ def _write_runtime_file(lat, lon, alt):
     try:
         path = Path(CFG["runtime_file_path"])
         path.parent.mkdir(parents=True, exist_ok=True)
-        tmp = path.with_suffix(".tmp")
-        tmp.write_text(json.dumps(payload), encoding="utf-8")
-        tmp.replace(path)
+        _atomic_write_bytes(path, orjson.dumps(payload))
     except Exception as e:
         print(f"[WARN] runtime file write failed: {e}")
 
+# Single-slot "latest wins" cell: bursts of updates collapse into one disk write.
+_writer_cell = [None]
+_writer_event = threading.Event()
+
+def _queue_runtime_write(lat, lon, alt):
+    _writer_cell[0] = (lat, lon, alt)
+    _writer_event.set()
+
+def runtime_writer_thread():
+    while True:
+        _writer_event.wait()
+        _writer_event.clear()
+        payload = _writer_cell[0]
+        if payload is not None:
+            _write_runtime_file(*payload)
+
+# Edits from /api/config are merged here and written to config.yaml by
+# config_persist_thread, keeping YAML and disk I/O off the request thread.
+_config_pending = {}
+_config_pending_lock = threading.Lock()
+_config_dirty = threading.Event()
+_config_write_lock = threading.Lock()
+CONFIG_PERSIST_DEBOUNCE_SEC = 0.5
+
+def _queue_config_persist(changed):
+    with _config_pending_lock:
+        _config_pending.update(changed)
+    _config_dirty.set()
+
+def _persist_config(changed):
+    cfg_path = Path("config.yaml")
+    on_disk = {}
+    if cfg_path.exists():
+        on_disk = yaml.safe_load(cfg_path.read_text(encoding="utf-8")) or {}
+    on_disk.update(changed)
+    data = yaml.safe_dump({**DEFAULT_CONFIG, **on_disk}, sort_keys=False).encode("utf-8")
+    # Replacing the file must not loosen permissions on an existing config.yaml.
+    mode, owner = 0o644, None
+    try:
+        st = cfg_path.stat()
+        mode, owner = stat.S_IMODE(st.st_mode), (st.st_uid, st.st_gid)
+    except FileNotFoundError:
+        pass
+    _atomic_write_bytes(cfg_path.resolve(), data, mode=mode, owner=owner)
+
+def flush_config_pending(timeout=-1):
+    # The write lock makes a shutdown flush wait for an in-flight background write.
+    if not _config_write_lock.acquire(timeout=timeout):
+        print("[WARN] Timed out waiting to flush config.yaml")
+        return
+    try:
+        with _config_pending_lock:
+            changed = dict(_config_pending)
+            _config_pending.clear()
+        if not changed or yaml is None:
+            return
+        try:
+            _persist_config(changed)
+        except Exception as e:
+            print(f"[WARN] Failed to write config.yaml: {e}")
+    finally:
+        _config_write_lock.release()
+
+def config_persist_thread():
+    while True:
+        _config_dirty.wait()
+        time.sleep(CONFIG_PERSIST_DEBOUNCE_SEC)  # coalesce bursts of edits
+        _config_dirty.clear()
+        flush_config_pending()
+
 def fetch_ntp_time():
-    global _last_ntp_utc
+    global _last_ntp_offset
     if ntplib is None: return
     try:
         client = ntplib.NTPClient()
         resp = client.request(CFG.get("ntp_server", "time.nist.gov"), version=3, timeout=5)
         with _ntp_lock:
-            _last_ntp_utc = datetime.fromtimestamp(resp.tx_time, tz=timezone.utc)
+            # NTPStats.offset is the four-timestamp estimate, so network delay cancels out.
+            _last_ntp_offset = resp.offset
     except Exception:
         pass
 
@@ -137,80 +423,143 @@ def ntp_thread():
         fetch_ntp_time()
         time.sleep(refresh)
 
+_last_body_hash = None
+_last_parsed = None
+_last_etag = None
+_last_modified = None
+# Bumped on every config change; a parse that straddles a bump is not cached,
+# since it may have used the old selector or key paths.
+_cache_gen = 0
+
+def reset_parse_cache():
+    global _last_body_hash, _last_parsed, _last_etag, _last_modified, _cache_gen
+    _cache_gen += 1
+    _last_body_hash = None
+    _last_parsed = None
+    _last_etag = None
+    _last_modified = None
+
+def parse_page(page):
+    sel = CFG["css_selector"]
+    raw = extract_selector_fast(page)
+    data = None
+    if raw is not None:
+        try:
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            data = None  # the fast path may have hit the wrong node; let bs4 decide
+    if data is None:
+        try:
+            raw = extract_selector_text(page, sel)
+            if raw is None:
+                return {"ok": False, "error": f"Selector '{sel}' not found"}
+            data = orjson.loads(raw)
+        except Exception as e:
+            return {"ok": False, "error": f"Parse error: {e}"}
+    if not isinstance(data, dict):
+        return {"ok": False, "error": "JSON root is not an object"}
+    try:
+        lat = float(get_by_path(data, _key_paths["latitude"]))
+        lon = float(get_by_path(data, _key_paths["longitude"]))
+    except (TypeError, ValueError):
+        return {"ok": False, "error": "Latitude/longitude missing or invalid"}
+    alt_raw = get_by_path(data, _key_paths["altitude"])
+    alt = coerce_float(alt_raw) if alt_raw is not None else None
+    gps_raw = get_by_path(data, _key_paths["gps_time"])
+    gps_ts = gps_seconds_to_ts(gps_raw, CFG["gps_leap_seconds"]) if gps_raw is not None else None
+    gps_utc = ts_to_utc(gps_ts) if gps_ts is not None else None
+    if gps_utc is None:
+        gps_ts = None
+    return {"ok": True, "latitude": lat, "longitude": lon, "altitude": alt,
+            "gps_utc": gps_utc, "gps_ts": gps_ts, "raw": raw}
+
 def fetch_and_parse_once():
+    global _last_body_hash, _last_parsed, _last_etag, _last_modified
+    gen = _cache_gen
+    cached = _last_parsed
     url = CFG["target_url"]
-    sel = CFG["css_selector"]
+    headers = {}
+    if cached is not None:
+        if _last_etag:
+            headers["If-None-Match"] = _last_etag
+        if _last_modified:
+            headers["If-Modified-Since"] = _last_modified
     try:
-        r = requests.get(url, timeout=CFG["request_timeout_sec"])
+        r = _session.get(url, headers=headers, timeout=CFG["request_timeout_sec"])
         r.raise_for_status()
     except Exception as e:
         return {"ok": False, "error": f"HTTP error: {e}"}
+    if r.status_code == 304:
+        if cached is not None and gen == _cache_gen:
+            return cached
+        reset_parse_cache()
+        return {"ok": False, "error": "HTTP 304 without a cached response"}
+    # The page only changes when the dish reports a new fix; skip parsing identical bodies.
+    h = blake2b(r.content, digest_size=16).digest()
+    if h == _last_body_hash and cached is not None and gen == _cache_gen:
+        return cached
+    res = _offload(parse_page, r.text)
+    if gen == _cache_gen:
+        _last_etag = r.headers.get("ETag", _last_etag)
+        _last_modified = r.headers.get("Last-Modified", _last_modified)
+        _last_body_hash, _last_parsed = h, res
+    return res
+
+def parse_poll_interval(v):
     try:
-        soup = BeautifulSoup(r.text, "html.parser")
-        node = soup.select_one(sel)
-        if node is None:
-            return {"ok": False, "error": f"Selector '{sel}' not found"}
-        raw = node.get_text(strip=True)
-        data = json.loads(raw)
-    except Exception as e:
-        return {"ok": False, "error": f"Parse error: {e}"}
-    if not isinstance(data, dict):
-        return {"ok": False, "error": "JSON root is not an object"}
-    lat = coerce_float(get_by_path(data, CFG["latitude_key"]))
-    lon = coerce_float(get_by_path(data, CFG["longitude_key"]))
-    alt_raw = get_by_path(data, CFG["altitude_key"])
-    alt = coerce_float(alt_raw) if alt_raw is not None else None
-    gps_raw = get_by_path(data, CFG["gps_time_key"])
-    gps_utc = gps_seconds_to_utc(gps_raw, CFG["gps_leap_seconds"]) if gps_raw is not None else None
-    if lat is None or lon is None:
-        return {"ok": False, "error": "Latitude/longitude missing or invalid"}
-    return {"ok": True, "latitude": lat, "longitude": lon, "altitude": alt, "gps_utc": gps_utc, "raw": data}
+        v = float(v)
+    except (TypeError, ValueError):
+        return None
+    return v if math.isfinite(v) and v > 0 else None
 
 def poller():
+    global _last_raw_json
     last = None
-    poll = CFG["poll_interval_sec"]
+    poll = 1.0
+    next_tick = time.monotonic()
     while True:
         res = fetch_and_parse_once()
         now_utc = datetime.now(timezone.utc)
+        now_ts = now_utc.timestamp()
         now_iso = now_utc.isoformat()
-        with _ntp_lock:
-            ntp_utc = _last_ntp_utc
-
         if res["ok"]:
+            # Format every timestamp and delta once, before publishing.
+            with _ntp_lock:
+                ntp_offset = _last_ntp_offset
+            ntp_ts = now_ts + ntp_offset if ntp_offset is not None else None
+            ntp_utc = ts_to_utc(ntp_ts) if ntp_ts is not None else None
+            gps_utc = res.get("gps_utc")
+            gps_ts = res.get("gps_ts") if gps_utc else None
+
+            fields = {
+                "pc_time_iso": now_iso,
+                "gps_time_iso": gps_utc.isoformat() if gps_utc else None,
+                "ntp_time_iso": ntp_utc.isoformat() if ntp_utc else None,
+                "delta_pc_vs_gps_ms": int((now_ts - gps_ts)*1000) if gps_ts is not None else None,
+                "delta_ntp_vs_pc_ms": int((ntp_ts - now_ts)*1000) if ntp_utc else None,
+                "delta_ntp_vs_gps_ms": int((ntp_ts - gps_ts)*1000) if ntp_utc and gps_ts is not None else None,
+                "note": "No new location update.",
+            }
             triplet = (res["latitude"], res["longitude"], res.get("altitude"))
             if triplet != last:
-                with _lock:
-                    _state.update({
-                        "latitude": res["latitude"],
-                        "longitude": res["longitude"],
-                        "altitude": res.get("altitude"),
-                        "last_raw": res["raw"],
-                        "last_update_iso": now_iso,
-                        "note": "Location updated."
-                    })
+                fields.update(latitude=triplet[0], longitude=triplet[1], altitude=triplet[2],
+                              last_update_iso=now_iso, note="Location updated.")
+                _last_raw_json = res["raw"]
+            _set_state(fields)
+            if triplet != last:
                 last = triplet
-                _write_runtime_file(*triplet)
-                _updates.put({"event": "update", "data": triplet, "time": now_iso})
-            else:
-                with _lock:
-                    _state["note"] = "No new location update."
-
-            gps_utc = res.get("gps_utc")
-            with _lock:
-                _state["pc_time_iso"] = now_iso
-                _state["gps_time_iso"] = gps_utc.isoformat() if gps_utc else None
-                _state["ntp_time_iso"] = ntp_utc.isoformat() if ntp_utc else None
-                _state["delta_pc_vs_gps_ms"] = int((now_utc - gps_utc).total_seconds()*1000) if gps_utc else None
-                if ntp_utc:
-                    _state["delta_ntp_vs_pc_ms"] = int((ntp_utc - now_utc).total_seconds()*1000)
-                    _state["delta_ntp_vs_gps_ms"] = int((ntp_utc - gps_utc).total_seconds()*1000) if gps_utc else None
-                else:
-                    _state["delta_ntp_vs_pc_ms"] = None
-                    _state["delta_ntp_vs_gps_ms"] = None
+                _queue_runtime_write(*triplet)
+                _publish({"event": "update", "data": triplet, "time": now_iso})
+        else:
+            _set_state({"note": f"Error: {res['error']}"})
+        # Schedule against fixed deadlines so slow fetches don't stretch the period.
+        poll = parse_poll_interval(CFG["poll_interval_sec"]) or poll  # keep the last good interval
+        next_tick += max(0.2, poll)
+        sleep_for = next_tick - time.monotonic()
+        if sleep_for > 0:
+            time.sleep(sleep_for)
         else:
-            with _lock:
-                _state["note"] = f"Error: {res['error']}"
-        time.sleep(max(0.2, poll))
+            next_tick = time.monotonic()
 
 @app.route("/")
 def index():
@@ -218,64 +567,135 @@ def index():
 
 @app.route("/api/state")
 def api_state():
-    with _lock:
-        return jsonify(_state)
+    state = _state
+    if request.args.get("include_raw") == "1":
+        raw = _last_raw_json
+        state = dict(state, last_raw=orjson.Fragment(raw) if raw is not None else None)
+    return Response(orjson.dumps(state), mimetype="application/json")
 
 @app.route("/api/config", methods=["GET", "POST"])
 def api_config():
+    global _session, _fast_sel, _key_paths
     if request.method == "GET":
-        public = {k: v for k, v in CFG.items()}
-        public["runtime_file_path"] = CFG["runtime_file_path"]
-        return jsonify(public)
+        return Response(_public_cfg_json, mimetype="application/json")
     body = request.json or {}
     allowed = [
         "target_url","css_selector","latitude_key","longitude_key","altitude_key",
         "gps_time_key","gps_leap_seconds","ntp_server","poll_interval_sec"
     ]
-    changed = {}
-    for k in allowed:
-        if k in body:
-            CFG[k] = body[k]
-            changed[k] = body[k]
-    with _lock:
-        _state["src_url"] = CFG["target_url"]
-    if yaml is not None:
-        cfg_path = Path("config.yaml")
-        try:
-            on_disk = {}
-            if cfg_path.exists():
-                on_disk = yaml.safe_load(cfg_path.read_text()) or {}
-            on_disk.update(changed)
-            cfg_path.write_text(yaml.safe_dump({**DEFAULT_CONFIG, **on_disk}, sort_keys=False), encoding="utf-8")
-        except Exception as e:
-            return jsonify({"ok": False, "error": f"Failed to write config.yaml: {e}"}), 500
+    if "poll_interval_sec" in body:
+        interval = parse_poll_interval(body["poll_interval_sec"])
+        if interval is None:
+            return jsonify({"ok": False, "error": "poll_interval_sec must be a positive number"}), 400
+        body["poll_interval_sec"] = interval
+    for k in KEY_FIELDS:
+        v = body.get(f"{k}_key")
+        if v is not None and not isinstance(v, str):
+            return jsonify({"ok": False, "error": f"{k}_key must be a string or null"}), 400
+    changed = {k: body[k] for k in allowed if k in body}
+    # Encode the new view first so an unencodable value is rejected before anything changes.
+    try:
+        view = _encode_cfg_view({**CFG, **changed})
+    except TypeError as e:
+        return jsonify({"ok": False, "error": f"Invalid config value: {e}"}), 400
+    old_url = CFG["target_url"]
+    CFG.update(changed)
+    if CFG["target_url"] != old_url:
+        old_session, _session = _session, _make_session()
+        old_session.close()
+    if "css_selector" in changed:
+        _fast_sel = compile_selector(CFG["css_selector"])
+    if any(k.endswith("_key") for k in changed):
+        _key_paths = build_key_paths(CFG)
+    if changed:
+        reset_parse_cache()
+        _rebuild_public_cfg_view(view)
+    _set_state({"src_url": CFG["target_url"]})
+    if changed:
+        _queue_config_persist(changed)
     return jsonify({"ok": True, "changed": changed})
 
+SSE_KEEPALIVE_SEC = 15
+
 @app.route("/stream")
 def stream():
     def gen():
-        with _lock:
-            if _state["latitude"] is not None and _state["longitude"] is not None:
-                first = {"event": "update",
-                         "data": [_state["latitude"], _state["longitude"], _state.get("altitude")],
-                         "time": _state["last_update_iso"]}
+        # Register before taking the snapshot so no update slips in between.
+        cond, dq = threading.Condition(), deque(maxlen=256)
+        with _subs_lock:
+            _subscribers.append((cond, dq))
+        first = None
+        snap = _state
+        if snap["latitude"] is not None and snap["longitude"] is not None:
+            first = {"event": "update",
+                     "data": [snap["latitude"], snap["longitude"], snap.get("altitude")],
+                     "time": snap["last_update_iso"]}
+        try:
+            if first is not None:
                 yield f"event: update\n"
-                yield f"data: {json.dumps(first)}\n\n"
-        while True:
-            item = _updates.get()
-            yield f"event: {item['event']}\n"
-            yield f"data: {json.dumps(item)}\n\n"
+                yield f"data: {orjson.dumps(first).decode()}\n\n"
+            while True:
+                with cond:
+                    if not cond.wait_for(lambda: dq, timeout=SSE_KEEPALIVE_SEC):
+                        items = None
+                    else:
+                        items = list(dq)
+                        dq.clear()
+                if items is None:
+                    # Comment line keeps idle proxies/NATs from dropping the connection.
+                    yield ": keepalive\n\n"
+                    continue
+                for item in items:
+                    yield f"event: {item['event']}\n"
+                    yield f"data: {orjson.dumps(item).decode()}\n\n"
+        finally:
+            with _subs_lock:
+                _subscribers.remove((cond, dq))
     return Response(gen(), mimetype="text/event-stream")
 
+_threads_started = False
+_threads_lock = threading.Lock()
+
 def start_threads():
+    global _threads_started
+    # Idempotent so repeated imports or callers never start duplicate pollers.
+    with _threads_lock:
+        if _threads_started:
+            return
+        _threads_started = True
+    # gunicorn workers exit normally rather than via handle_sigterm.
+    atexit.register(flush_config_pending, timeout=5)
     threading.Thread(target=poller, name="poller", daemon=True).start()
+    threading.Thread(target=runtime_writer_thread, name="runtime-writer", daemon=True).start()
+    threading.Thread(target=config_persist_thread, name="config-persist", daemon=True).start()
     if ntplib is not None:
         threading.Thread(target=ntp_thread, name="ntp", daemon=True).start()
 
+def run_production():
+    # gevent multiplexes every /stream client over one worker thread. Run gunicorn
+    # on this interpreter so a systemd unit without the venv on PATH still works.
+    missing = [m for m in ("gunicorn", "gevent") if find_spec(m) is None]
+    if missing:
+        print(f"[WARN] PRODUCTION=1 but {', '.join(missing)} not installed; using Flask dev server")
+        return
+    host, port = CFG["bind_host"], CFG["bind_port"]
+    try:
+        os.execv(sys.executable, [
+            sys.executable, "-m", "gunicorn", "-k", "gevent", "-w", "1",
+            "--chdir", str(Path(__file__).resolve().parent),
+            "-b", f"{host}:{port}", "wsgi:application",
+        ])
+    except OSError as e:
+        print(f"[WARN] failed to exec gunicorn ({e}); using Flask dev server")
+
 def main():
+    if os.environ.get("PRODUCTION") == "1":
+        run_production()
     start_threads()
     def handle_sigterm(signum, frame):
-        print("Received SIGTERM, exiting..."); os._exit(0)
+        print("Received SIGTERM, exiting...")
+        flush_config_pending(timeout=5)
+        os._exit(0)
     signal.signal(signal.SIGTERM, handle_sigterm)
     app.run(host=CFG["bind_host"], port=CFG["bind_port"], threaded=True)
 
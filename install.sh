@@ -18,13 +18,14 @@ Options:
   --alt-key KEY            Dotted key for altitude
   --gps-key KEY            Dotted key for gpsTimeS
   --ntp-server HOST        NTP server (default: time.nist.gov)
+  --production             Install gunicorn+gevent and run the service with PRODUCTION=1
   --service                Install as a systemd user service
   --start                  Start service immediately
   -h, --help               Show this help
 EOF
 }
 
-URL="" SELECTOR="" LAT_KEY="" LON_KEY="" ALT_KEY="" GPS_KEY="" NTP_SRV="" DO_SERVICE="false" START_AFTER="false"
+URL="" SELECTOR="" LAT_KEY="" LON_KEY="" ALT_KEY="" GPS_KEY="" NTP_SRV="" DO_PRODUCTION="false" DO_SERVICE="false" START_AFTER="false"
 
 while [[ $# -gt 0 ]]; do
   case "$1" in
@@ -35,6 +36,7 @@ while [[ $# -gt 0 ]]; do
     --alt-key) ALT_KEY="$2"; shift 2;;
     --gps-key) GPS_KEY="$2"; shift 2;;
     --ntp-server) NTP_SRV="$2"; shift 2;;
+    --production) DO_PRODUCTION="true"; shift;;
     --service) DO_SERVICE="true"; shift;;
     --start) DO_SERVICE="true"; START_AFTER="true"; shift;;
     -h|--help) usage; exit 0;;
@@ -56,6 +58,9 @@ venv_setup() {
   echo "[*] Installing Python dependencies…"
   pip install --upgrade pip
   pip install -r "${APP_DIR}/requirements.txt"
+  if [[ "${DO_PRODUCTION}" == "true" ]]; then
+    pip install -r "${APP_DIR}/requirements-production.txt"
+  fi
 }
 
 apply_config() {
@@ -84,12 +89,17 @@ PY
 install_service() {
   echo "[*] Creating user-level systemd service…"
   mkdir -p "$(dirname "${SERVICE_FILE}")"
+  local env_line=""
+  if [[ "${DO_PRODUCTION}" == "true" ]]; then
+    env_line="Environment=PRODUCTION=1"
+  fi
   cat > "${SERVICE_FILE}" <<EOF
 [Unit]
 Description=Location Watcher
 
 [Service]
 WorkingDirectory=%h/$(basename "${APP_DIR}")
+${env_line}
 ExecStart=%h/$(basename "${APP_DIR}")/.venv/bin/python %h/$(basename "${APP_DIR}")/app.py
 Restart=always
 RestartSec=3
@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+# WSGI entrypoint, e.g.: gunicorn -k gevent -w 1 wsgi:application
+# Keep a single worker: poller state and SSE subscribers live in-process.
+from app import app, start_threads
+
+start_threads()
+application = app